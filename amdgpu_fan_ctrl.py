@@ -24,10 +24,20 @@ __author__ = "Luís Gomes <luismsgomes@gmail.com>"
 # which is also distributed under the MIT license.
 
 
+import bisect
+import collections
+import configparser
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import json
 import logging
+import math
 import os.path
+import pstats
 import re
+import signal
+import threading
 import time
 
 
@@ -51,11 +61,83 @@ HOT = 75.0  # celcius degrees
 # how much percent of fan speed do we change at a time
 FAN_DELTA = 1.0  # percent
 
+# fan curves are read from this file if it exists (see README.md); without a
+# fan curve, fan speed is controlled with COLD, HOT and FAN_DELTA
+CONFIG_FILE = "/etc/amdgpu-fan-ctrl.conf"
+
+# fan curves are compiled into lookup tables covering this range of temperatures
+# with this resolution
+CURVE_MIN_TEMP = 0.0  # celcius degrees
+CURVE_MAX_TEMP = 120.0  # celcius degrees
+CURVE_RESOLUTION = 0.1  # celcius degrees
+
+# fan curves ignore differences between actual and target fan speed smaller
+# than this (fan speed can only be set in steps of 1/pwm1_max)
+CURVE_FAN_TOLERANCE = 0.5  # percent
+
+# with a temperature filter, the builtin fan control only gets a nonzero rate
+# once the filtered temperature has moved at least this much since it last did;
+# a filtered rate decays slowly and is almost never zero, so without this band
+# the fan would be adjusted on every update
+FILTER_BAND = 0.8  # celcius degrees
+
+# controller state is checkpointed to this file after every update so that a
+# restarted daemon can resume control without rediscovering devices
+# (/run is a tmpfs, so the file never survives a reboot)
+STATE_FILE = "/run/amdgpu-fan-ctrl.json"
+
+# saved state older than this is ignored on startup
+STATE_MAX_AGE = 30  # seconds
+
+# bump whenever the layout of the saved state changes
+STATE_FORMAT = 1
+
+# upper bounds of the timing histogram buckets kept for each phase of an update
+# (a last bucket collects everything slower than the last bound)
+STATS_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0)  # seconds
+
+# how long the cProfile window started by SIGUSR2 lasts
+PROFILE_SECS = 60  # seconds
+
+# how many functions are shown when the cProfile window ends
+PROFILE_LINES = 25
+
 DRMPREFIX = "/sys/class/drm"
 HWMONPREFIX = "/sys/class/hwmon"
 DEBUGPREFIX = "/sys/kernel/debug/dri"
 MODULEPREFIX = "/sys/module"
 
+
+class ValuePaths(dict):
+    """The VALUEPATHS map.
+
+    Entries for firmware versions are rarely used, so they are only built when
+    first looked up (see VALIDFWBLOCKS).
+    """
+
+    def __missing__(self, key):
+        block, _, suffix = key.rpartition("_")
+        if suffix != "version" or not block.endswith("_fw"):
+            raise KeyError(key)
+        block = block[: -len("_fw")]
+        if block not in VALIDFWBLOCKS:
+            raise KeyError(key)
+        path_dict = self[key] = {
+            "prefix": DRMPREFIX,
+            "filepath": "fw_version/%s_fw_version" % block,
+            # SMC has different formatting for its version
+            "needsparse": block in ("smc", "ta_ras", "ta_xgmi"),
+        }
+        return path_dict
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
 VALUEPATHS = {
     "id": {"prefix": DRMPREFIX, "filepath": "device", "needsparse": True},
     "sub_id": {
@@ -278,6 +360,7 @@ VALUEPATHS = {
         "needsparse": False,
     },
 }
+VALUEPATHS = ValuePaths(VALUEPATHS)
 
 # Supported firmware blocks
 VALIDFWBLOCKS = {
@@ -304,17 +387,6 @@ VALIDFWBLOCKS = {
     "dmcu",
 }
 
-for block in VALIDFWBLOCKS:
-    VALUEPATHS["%s_fw_version" % block] = {
-        "prefix": DRMPREFIX,
-        "filepath": "fw_version/%s_fw_version" % block,
-        "needsparse": False,
-    }
-# SMC has different formatting for its version
-VALUEPATHS["smc_fw_version"]["needsparse"] = True
-VALUEPATHS["ta_ras_fw_version"]["needsparse"] = True
-VALUEPATHS["ta_xgmi_fw_version"]["needsparse"] = True
-
 
 def parse_device_name(device_name):
     """Parse the device name, which is of the format card#.
@@ -433,7 +505,7 @@ def set_sysfs_value(device: str, key: str, value: str):
             device, key, value, file_path, "File does not exist"
         )
     try:
-        logging.debug(f"Writing value {value!r} to file {file_path!r}")
+        logging.debug("Writing value %r to file %r", value, file_path)
         with open(file_path, "w") as f:
             f.write(value + "\n")  # Certain sysfs files require \n at the end
     except (IOError, OSError):
@@ -452,6 +524,9 @@ def is_amd_device(device: str):
     return False
 
 
+CARD_RE = re.compile(r"^card\d+$")
+
+
 def get_all_devices():
     """ Return a list of GPU devices."""
 
@@ -459,11 +534,14 @@ def get_all_devices():
         logging.error("Unable to get devices, /sys/class/drm is empty or missing")
         return None
 
-    devices = [
-        device
-        for device in os.listdir(DRMPREFIX)
-        if re.match(r"^card\d+$", device) and is_amd_device(device)
-    ]
+    # connectors (e.g. card0-DP-1) are filtered out before reading any file
+    devices = [device for device in os.listdir(DRMPREFIX) if CARD_RE.match(device)]
+    with ThreadPoolExecutor() as executor:
+        devices = [
+            device
+            for device, is_amd in zip(devices, executor.map(is_amd_device, devices))
+            if is_amd
+        ]
     return sorted(devices, key=lambda x: int(x.partition("card")[2]))
 
 
@@ -481,17 +559,48 @@ def list_amd_hw_monitors():
     return hwmons
 
 
+# HW Monitors already resolved by get_hw_monitor_from_device(), by device
+HWMON_INDEX = {}
+
+
 def get_hw_monitor_from_device(device: str):
     """Return the corresponding HW Monitor for a specified GPU device.
 
     Parameters:
     device -- DRM device identifier
+
+    Known HW Monitors are kept in HWMON_INDEX and are only looked up again
+    if they no longer point to the given device.
     """
     drmdev = os.path.realpath(os.path.join(DRMPREFIX, device, "device"))
+    hwmon = HWMON_INDEX.get(device)
+    if hwmon and os.path.realpath(os.path.join(hwmon, "device")) == drmdev:
+        return hwmon
+    start = STATS.clock()
+    HWMON_INDEX.pop(device, None)
     for hwmon in list_amd_hw_monitors():
         if os.path.realpath(os.path.join(hwmon, "device")) == drmdev:
-            return hwmon
-    return None
+            HWMON_INDEX[device] = hwmon
+            break
+    STATS.lap("discovery", start)
+    return HWMON_INDEX.get(device)
+
+
+def build_hwmon_index(devices):
+    """Resolve the HW Monitors of all given devices into HWMON_INDEX with a
+    single scan of the HW Monitors.
+
+    Parameters:
+    devices -- DRM device identifiers
+    """
+    hwmons = {
+        os.path.realpath(os.path.join(hwmon, "device")): hwmon
+        for hwmon in list_amd_hw_monitors()
+    }
+    for device in devices:
+        drmdev = os.path.realpath(os.path.join(DRMPREFIX, device, "device"))
+        if drmdev in hwmons:
+            HWMON_INDEX[device] = hwmons[drmdev]
 
 
 def get_key_file_path(device: str, key: str):
@@ -501,22 +610,21 @@ def get_key_file_path(device: str, key: str):
     device -- Device whose filepath will be returned
     key -- [$VALUEPATHS.keys()] The sysfs path to return
     """
-    if key not in VALUEPATHS.keys():
+    if key not in VALUEPATHS:
         logging.warning("Key %s not present in VALUEPATHS map" % key)
         return None
     path_dict = VALUEPATHS[key]
 
     if path_dict["prefix"] == HWMONPREFIX:
         # HW Monitor values have a different path structure
-        if not get_hw_monitor_from_device(device):
+        hwmon = get_hw_monitor_from_device(device)
+        if not hwmon:
             logging.warning(
                 "GPU[%s]\t: No corresponding HW Monitor found",
                 parse_device_name(device),
             )
             return None
-        file_path = os.path.join(
-            get_hw_monitor_from_device(device), path_dict["filepath"]
-        )
+        file_path = os.path.join(hwmon, path_dict["filepath"])
     elif path_dict["prefix"] == DEBUGPREFIX:
         # Kernel DebugFS values have a different path structure
         file_path = os.path.join(
@@ -560,6 +668,9 @@ def is_dpm_available(device):
     return True
 
 
+TEMP_KEYS = tuple((i, f"temp{i}", f"temp{i}_label") for i in range(1, 4))
+
+
 def get_temps(device: str):
     """Return the current temperatures for a given device.
 
@@ -567,11 +678,11 @@ def get_temps(device: str):
     device -- DRM device
     """
     temps = dict()
-    # We currently have temp1/2/3, so use range(1,4)
-    for i in range(1, 4):
-        temp = get_sysfs_value(device, f"temp{i}")
+    # We currently have temp1/2/3
+    for i, key, label_key in TEMP_KEYS:
+        temp = get_sysfs_value(device, key)
         if temp:
-            label = get_sysfs_value(device, f"temp{i}_label") or i
+            label = get_sysfs_value(device, label_key) or i
             temps[label] = temp
     return temps
 
@@ -593,7 +704,7 @@ def get_fan_speed(device: str):
     if not fan_level or not fan_max:
         return None
     fan_speed_percent = 100 * float(fan_level) / float(fan_max)
-    logging.debug(f"device {device} fan speed: {fan_speed_percent}%")
+    logging.debug("device %s fan speed: %s%%", device, fan_speed_percent)
     return fan_speed_percent
 
 
@@ -604,10 +715,10 @@ class UnableToSetFanSpeedException(Exception):
 def set_fan_speed(device: str, fan_speed: float):
     """Set fan speed for a device."""
     if not is_dpm_available(device):
-        logging.warning(f"GPU[{device}]: DPM is not available for this device")
+        logging.warning("GPU[%s]: DPM is not available for this device", device)
         raise UnableToSetFanSpeedException
 
-    logging.debug(f"setting device {device} fan speed: {fan_speed}%")
+    logging.debug("setting device %s fan speed: %s%%", device, fan_speed)
 
     fanpath = get_key_file_path(device, "fan")
     maxfan = get_sysfs_value(device, "fanmax")
@@ -615,13 +726,13 @@ def set_fan_speed(device: str, fan_speed: float):
 
     if maxfan is None:
         logging.warning(
-            f"GPU[{device}]: Unable to get maxfan value (file {fanpath!r} is empty)"
+            "GPU[%s]: Unable to get maxfan value (file %r is empty)", device, fanpath
         )
         raise UnableToSetFanSpeedException
 
     if fanmode != "1":
         set_sysfs_value(device, "fanmode", "1")
-        logging.debug(f"GPU[{device}]: Successfully set fan control to 'manual'")
+        logging.debug("GPU[%s]: Successfully set fan control to 'manual'", device)
 
     maxfan = int(maxfan)
     fan_speed_abs = int((fan_speed * maxfan) / 100.0)
@@ -678,9 +789,684 @@ def compute_fan_speed_delta(temp: float, temp_delta: float, fan_speed: float):
     return 0.0
 
 
+class InvalidConfigException(Exception):
+    pass
+
+
+class FanCurve:
+    """Fan speed as a function of temperature, compiled into a lookup table.
+
+    Parameters:
+    points -- (temperature, fan speed %) pairs, with increasing temperatures
+              and non-decreasing fan speeds
+    interpolation -- "linear" or "spline" (monotone cubic, never overshoots)
+    hysteresis -- fan speed is only decreased once temperature drops this many
+                  celcius degrees below the temperature that requires it
+
+    Like the builtin fan control, the curve never runs the fan slower than
+    MIN_FAN_SPEED: such speeds are raised to MIN_FAN_SPEED.
+    """
+
+    INTERPOLATIONS = ("linear", "spline")
+
+    def __init__(self, points, interpolation="linear", hysteresis=0.0):
+        if len(points) < 2:
+            raise InvalidConfigException("a fan curve needs at least two points")
+        temps, speeds = zip(*points)
+        if not all(math.isfinite(value) for value in temps + speeds):
+            raise InvalidConfigException("fan curve points must be finite numbers")
+        if any(t0 >= t1 for t0, t1 in zip(temps, temps[1:])):
+            raise InvalidConfigException("fan curve temperatures must increase")
+        if any(s0 > s1 for s0, s1 in zip(speeds, speeds[1:])):
+            raise InvalidConfigException("fan curve speeds must not decrease")
+        if speeds[0] < 0.0 or speeds[-1] > 100.0:
+            raise InvalidConfigException("fan curve speeds must be within 0-100%")
+        if interpolation not in self.INTERPOLATIONS:
+            raise InvalidConfigException(f"unknown interpolation {interpolation!r}")
+        if not 0.0 <= hysteresis < math.inf:
+            raise InvalidConfigException("hysteresis must be a non-negative number")
+        self.points = tuple(points)
+        self.interpolation = interpolation
+        self.hysteresis = hysteresis
+        self.hysteresis_steps = round(hysteresis / CURVE_RESOLUTION)
+        if interpolation == "spline":
+            tangents = monotone_tangents(temps, speeds)
+        else:
+            tangents = None
+        size = round((CURVE_MAX_TEMP - CURVE_MIN_TEMP) / CURVE_RESOLUTION) + 1
+        self.table = [
+            min_fan_speed(
+                interpolate(
+                    temps, speeds, tangents, CURVE_MIN_TEMP + i * CURVE_RESOLUTION
+                )
+            )
+            for i in range(size)
+        ]
+
+    def index(self, temp: float):
+        i = int((temp - CURVE_MIN_TEMP) / CURVE_RESOLUTION + 0.5)
+        return min(max(i, 0), len(self.table) - 1)
+
+    def fan_speed(self, temp: float):
+        return self.table[self.index(temp)]
+
+    def fan_speed_delta(self, temp: float, fan_speed: float):
+        """Return how much the fan speed should change at given temperature."""
+        i = self.index(temp)
+        target = self.table[i]
+        if target - fan_speed >= CURVE_FAN_TOLERANCE:
+            return target - fan_speed
+        # when cooling down, follow the curve shifted by the hysteresis
+        target = self.table[min(i + self.hysteresis_steps, len(self.table) - 1)]
+        if fan_speed - target >= CURVE_FAN_TOLERANCE:
+            return target - fan_speed
+        return 0.0
+
+
+def min_fan_speed(fan_speed: float):
+    """Return the given fan speed raised to MIN_FAN_SPEED unless it is zero."""
+    if 0.0 < fan_speed < MIN_FAN_SPEED:
+        return MIN_FAN_SPEED
+    return fan_speed
+
+
+def monotone_tangents(xs, ys):
+    """Return the tangents of a monotone cubic Hermite spline through the given
+    points (Fritsch-Carlson method)."""
+    secants = [
+        (y1 - y0) / (x1 - x0) for x0, x1, y0, y1 in zip(xs, xs[1:], ys, ys[1:])
+    ]
+    tangents = [secants[0]]
+    for s0, s1 in zip(secants, secants[1:]):
+        tangents.append((s0 + s1) / 2 if s0 * s1 > 0 else 0.0)
+    tangents.append(secants[-1])
+    for k, secant in enumerate(secants):
+        if secant == 0.0:
+            tangents[k] = tangents[k + 1] = 0.0
+            continue
+        a, b = tangents[k] / secant, tangents[k + 1] / secant
+        if a * a + b * b > 9.0:
+            tau = 3.0 / (a * a + b * b) ** 0.5
+            tangents[k] = tau * a * secant
+            tangents[k + 1] = tau * b * secant
+    return tangents
+
+
+def interpolate(xs, ys, tangents, x):
+    """Evaluate the curve through the given points at x, either linearly or,
+    if tangents are given, with a cubic Hermite spline; outside of the points
+    the curve is flat."""
+    if x <= xs[0]:
+        return ys[0]
+    if x >= xs[-1]:
+        return ys[-1]
+    k = bisect.bisect_right(xs, x) - 1
+    h = xs[k + 1] - xs[k]
+    t = (x - xs[k]) / h
+    if tangents is None:
+        return ys[k] + t * (ys[k + 1] - ys[k])
+    t2, t3 = t * t, t * t * t
+    return (
+        (2 * t3 - 3 * t2 + 1) * ys[k]
+        + (t3 - 2 * t2 + t) * h * tangents[k]
+        + (-2 * t3 + 3 * t2) * ys[k + 1]
+        + (t3 - t2) * h * tangents[k + 1]
+    )
+
+
+def parse_curve_points(value: str):
+    """Parse fan curve points given as "temp:speed" pairs, e.g. "50:0 75:100".
+
+    Parameters:
+    value -- pairs separated by commas and/or whitespace
+    """
+    points = []
+    for pair in re.split(r"[\s,]+", value.strip()):
+        temp, _, speed = pair.partition(":")
+        try:
+            point = (float(temp), float(speed))
+        except ValueError:
+            point = None
+        if point is None or not all(math.isfinite(value) for value in point):
+            raise InvalidConfigException(f"invalid fan curve point {pair!r}")
+        points.append(point)
+    return points
+
+
+def config_section_key(section: str):
+    """Return the key used to match a config section with devices.
+
+    Sections are named "default", after a DRM device (e.g. "card0") or after
+    a PCI device id optionally followed by a subsystem id (e.g. "pci:67df" or
+    "pci:67df:e353").  Ids are zero-padded to four digits, like in sysfs.
+    """
+    key = section.strip().lower()
+    if key == "default" or re.match(r"^card\d+$", key):
+        return key
+    parts = key.split(":")
+    if parts[0] == "pci" and len(parts) in (2, 3):
+        ids = [part[2:] if part.startswith("0x") else part for part in parts[1:]]
+        if all(re.match(r"^[0-9a-f]{1,4}$", pci_id) for pci_id in ids):
+            return ":".join(["pci"] + [pci_id.zfill(4) for pci_id in ids])
+    raise InvalidConfigException(f"invalid section name {section!r}")
+
+
+class EmaFilter:
+    """Exponential moving average of the temperature and of its rate.
+
+    Parameters:
+    alpha -- weight of each new sample, between 0 (exclusive) and 1
+    """
+
+    NAME = "ema"
+    PARAMS = (("alpha", float),)
+
+    def __init__(self, alpha: float = 0.3):
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError("filter_alpha must be within ]0, 1]")
+        self.alpha = alpha
+        self.temp = None
+        self.rate = 0.0
+        self.timestamp = None
+
+    def params(self):
+        return {"alpha": self.alpha}
+
+    def update(self, temp: float, timestamp: float):
+        """Add a sample and return the filtered temperature and rate."""
+        if self.temp is None or timestamp <= self.timestamp:
+            self.temp, self.timestamp = temp, timestamp
+            return self.temp, self.rate
+        prev_temp = self.temp
+        self.temp += self.alpha * (temp - self.temp)
+        rate = (self.temp - prev_temp) / (timestamp - self.timestamp)
+        self.rate += self.alpha * (rate - self.rate)
+        self.timestamp = timestamp
+        return self.temp, self.rate
+
+    def get_state(self):
+        return {"temp": self.temp, "rate": self.rate, "timestamp": self.timestamp}
+
+    def set_state(self, state: dict):
+        self.temp = float(state["temp"])
+        self.rate = float(state["rate"])
+        self.timestamp = float(state["timestamp"])
+
+
+class WindowFilter:
+    """Least squares line fitted to the last samples of the temperature.
+
+    Parameters:
+    size -- number of samples in the window
+    """
+
+    NAME = "window"
+    PARAMS = (("size", int),)
+
+    def __init__(self, size: int = 5):
+        if size < 2:
+            raise ValueError("filter_size must be at least 2")
+        self.size = size
+        self.samples = collections.deque(maxlen=size)
+
+    def params(self):
+        return {"size": self.size}
+
+    def update(self, temp: float, timestamp: float):
+        """Add a sample and return the filtered temperature and rate."""
+        if self.samples and timestamp <= self.samples[-1][0]:
+            self.samples.pop()
+        self.samples.append((timestamp, temp))
+        n = len(self.samples)
+        # times are taken relative to the last sample to keep them small
+        mean_t = sum(t - timestamp for t, _ in self.samples) / n
+        mean_temp = sum(y for _, y in self.samples) / n
+        var_t = sum((t - timestamp - mean_t) ** 2 for t, _ in self.samples)
+        if not var_t:
+            return temp, 0.0
+        rate = (
+            sum(
+                (t - timestamp - mean_t) * (y - mean_temp) for t, y in self.samples
+            )
+            / var_t
+        )
+        return mean_temp - rate * mean_t, rate
+
+    def get_state(self):
+        return {"samples": list(self.samples)}
+
+    def set_state(self, state: dict):
+        samples = [(float(t), float(temp)) for t, temp in state["samples"]]
+        self.samples.clear()
+        self.samples.extend(samples)
+
+
+class KalmanFilter:
+    """Kalman filter tracking the temperature and its rate, assuming the rate
+    changes randomly (constant velocity model).
+
+    Parameters:
+    process_noise -- variance of the rate changes, in (celcius degrees/s)^2/s
+    measurement_noise -- variance of the sensor readings, in celcius degrees^2
+    """
+
+    NAME = "kalman"
+    PARAMS = (("process_noise", float), ("measurement_noise", float))
+
+    def __init__(self, process_noise: float = 0.0001, measurement_noise: float = 0.25):
+        if not (
+            0.0 < process_noise < math.inf and 0.0 < measurement_noise < math.inf
+        ):
+            raise ValueError("filter noise variances must be positive numbers")
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.temp = None
+        self.rate = 0.0
+        self.covariance = [measurement_noise, 0.0, 0.0, 1.0]
+        self.timestamp = None
+
+    def params(self):
+        return {
+            "process_noise": self.process_noise,
+            "measurement_noise": self.measurement_noise,
+        }
+
+    def update(self, temp: float, timestamp: float):
+        """Add a sample and return the filtered temperature and rate."""
+        if self.temp is None:
+            self.temp, self.timestamp = temp, timestamp
+            return self.temp, self.rate
+        dt = max(timestamp - self.timestamp, 0.0)
+        self.timestamp = timestamp
+        # predict
+        p00, p01, p10, p11 = self.covariance
+        q = self.process_noise
+        self.temp += self.rate * dt
+        p00 += dt * (p10 + p01 + dt * p11) + q * dt ** 3 / 3
+        p01 += dt * p11 + q * dt ** 2 / 2
+        p10 += dt * p11 + q * dt ** 2 / 2
+        p11 += q * dt
+        # correct
+        k0 = p00 / (p00 + self.measurement_noise)
+        k1 = p10 / (p00 + self.measurement_noise)
+        residual = temp - self.temp
+        self.temp += k0 * residual
+        self.rate += k1 * residual
+        self.covariance = [
+            (1 - k0) * p00,
+            (1 - k0) * p01,
+            p10 - k1 * p00,
+            p11 - k1 * p01,
+        ]
+        return self.temp, self.rate
+
+    def get_state(self):
+        return {
+            "temp": self.temp,
+            "rate": self.rate,
+            "covariance": self.covariance,
+            "timestamp": self.timestamp,
+        }
+
+    def set_state(self, state: dict):
+        p00, p01, p10, p11 = (float(p) for p in state["covariance"])
+        self.temp = float(state["temp"])
+        self.rate = float(state["rate"])
+        self.covariance = [p00, p01, p10, p11]
+        self.timestamp = float(state["timestamp"])
+
+
+TEMP_FILTERS = {cls.NAME: cls for cls in (EmaFilter, WindowFilter, KalmanFilter)}
+
+
+class DeviceConfig:
+    """Settings of a config file section (see load_config()).
+
+    Parameters:
+    fan_curve -- FanCurve, or None for the builtin fan control
+    filter_class -- one of TEMP_FILTERS, or None to use raw temperatures
+    filter_params -- keyword arguments for filter_class
+    filter_band -- see FILTER_BAND
+    rate_deadband -- temperature rates smaller than this (in celcius degrees
+                     per second) are taken as zero
+    """
+
+    def __init__(
+        self,
+        fan_curve=None,
+        filter_class=None,
+        filter_params=None,
+        filter_band=FILTER_BAND,
+        rate_deadband=0.0,
+    ):
+        self.fan_curve = fan_curve
+        self.filter_class = filter_class
+        self.filter_params = filter_params or {}
+        self.filter_band = filter_band
+        self.rate_deadband = rate_deadband
+
+    def new_filter(self):
+        if self.filter_class is None:
+            return None
+        return self.filter_class(**self.filter_params)
+
+    def matches_filter(self, temp_filter):
+        """Return whether temp_filter was created by new_filter()."""
+        if temp_filter is None:
+            return self.filter_class is None
+        return (
+            type(temp_filter) is self.filter_class
+            and temp_filter.params() == self.filter_class(**self.filter_params).params()
+        )
+
+
+def parse_config_float(options, name: str, default: float = None):
+    """Return a number option of a config file section, which must be finite
+    (float() also accepts "nan" and "inf")."""
+    value = options.getfloat(name, default)
+    if not math.isfinite(value):
+        raise InvalidConfigException(f"{name} must be a finite number")
+    return value
+
+
+CURVE_OPTIONS = ("points", "interpolation", "hysteresis")
+FILTER_OPTIONS = ("filter", "filter_band", "rate_deadband")
+
+
+def parse_config_section(options):
+    """Return the DeviceConfig for a config file section."""
+    points = options.get("points")
+    if points is None:
+        for name in CURVE_OPTIONS:
+            if name in options:
+                raise InvalidConfigException(f"{name} requires points")
+    if points is None:
+        fan_curve = None
+    else:
+        fan_curve = FanCurve(
+            parse_curve_points(points),
+            interpolation=options.get("interpolation", "linear"),
+            hysteresis=parse_config_float(options, "hysteresis", 0.0),
+        )
+    filter_name = options.get("filter", "none")
+    if filter_name == "none":
+        filter_class, filter_params = None, {}
+    elif filter_name in TEMP_FILTERS:
+        filter_class = TEMP_FILTERS[filter_name]
+        filter_params = {
+            name: parse_config_float(options, f"filter_{name}")
+            if type_ is float
+            else type_(options[f"filter_{name}"])
+            for name, type_ in filter_class.PARAMS
+            if f"filter_{name}" in options
+        }
+        filter_class(**filter_params)  # validate the parameters
+    else:
+        raise InvalidConfigException(f"unknown filter {filter_name!r}")
+    if fan_curve is not None:
+        for name in FILTER_OPTIONS:
+            if name in options:
+                raise InvalidConfigException(
+                    f"{name} has no effect with a fan curve (points)"
+                )
+    known_options = set(CURVE_OPTIONS + FILTER_OPTIONS)
+    if filter_class is not None:
+        known_options.update(f"filter_{name}" for name, _ in filter_class.PARAMS)
+    for name in options:
+        if name not in known_options:
+            raise InvalidConfigException(f"unknown option {name!r}")
+    filter_band = parse_config_float(options, "filter_band", FILTER_BAND)
+    if filter_band < 0.0:
+        raise InvalidConfigException("filter_band must not be negative")
+    rate_deadband = parse_config_float(options, "rate_deadband", 0.0)
+    if rate_deadband < 0.0:
+        raise InvalidConfigException("rate_deadband must not be negative")
+    return DeviceConfig(
+        fan_curve, filter_class, filter_params, filter_band, rate_deadband
+    )
+
+
+def load_config(path: str = CONFIG_FILE):
+    """Return the DeviceConfig of each section of a config file, by section key
+    (see config_section_key()), or an empty dict if the file does not exist.
+
+    Parameters:
+    path -- config file in INI format
+    """
+    # "%" is a natural character in fan speeds, so no interpolation; sections
+    # can't be named "\n", so [DEFAULT] is an ordinary section (see
+    # config_section_key()) and its options don't leak into the other sections
+    parser = configparser.ConfigParser(interpolation=None, default_section="\n")
+    try:
+        with open(path, "r") as f:
+            parser.read_file(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, configparser.Error) as e:
+        raise InvalidConfigException(f"{path}: {e}")
+    configs = {}
+    for section in parser.sections():
+        try:
+            key = config_section_key(section)
+            if key in configs:
+                raise InvalidConfigException("section given more than once")
+            configs[key] = parse_config_section(parser[section])
+        except (
+            InvalidConfigException,
+            configparser.Error,
+            ValueError,
+            ArithmeticError,
+        ) as e:
+            raise InvalidConfigException(f"{path}: [{section}]: {e}")
+    return configs
+
+
+def find_device_config(configs: dict, device: str):
+    """Return the DeviceConfig that applies to a device.
+
+    Parameters:
+    configs -- DeviceConfigs returned by load_config()
+    device -- DRM device identifier
+
+    A section for the device itself takes precedence over one for its PCI
+    device and subsystem ids, which takes precedence over one for its PCI
+    device id only, which takes precedence over the default section.
+    """
+    if not configs:
+        return DeviceConfig()
+    if device in configs:
+        return configs[device]
+    pci_id = (get_sysfs_value(device, "id") or "").lower()
+    sub_id = (get_sysfs_value(device, "sub_id") or "").lower()
+    if sub_id.startswith("0x"):
+        sub_id = sub_id[2:]
+    for key in (f"pci:{pci_id}:{sub_id}", f"pci:{pci_id}", "default"):
+        if key in configs:
+            return configs[key]
+    return DeviceConfig()
+
+
+def apply_config(monitors, path: str = CONFIG_FILE):
+    """(Re)load the config file and apply it to device monitors.
+
+    If the config file is invalid the monitors keep their current settings.
+    Temperature filters whose settings did not change keep their state.
+    """
+    try:
+        configs = load_config(path)
+    except InvalidConfigException as e:
+        logging.error("Keeping current settings, invalid config: %s", e)
+        return
+    for monitor in monitors:
+        monitor.configure(find_device_config(configs, monitor.device))
+        logging.info(
+            "GPU[%s]: %s, %s",
+            parse_device_name(monitor.device),
+            "using fan curve %s" % (monitor.fan_curve.points,)
+            if monitor.fan_curve
+            else "using builtin fan control",
+            "%s filter %s" % (monitor.temp_filter.NAME, monitor.temp_filter.params())
+            if monitor.temp_filter
+            else "no filter",
+        )
+
+
+class Stats:
+    """Per-phase counters and timing histograms for the control loop.
+
+    Phases are timed by chaining clock() and lap() calls; while disabled both
+    return immediately without reading the clock.  The "startup" phase covers
+    everything until the monitors are ready, including its "discovery" laps.
+    A cProfile window can also be opened for a limited time with
+    start_profile().
+    """
+
+    PHASES = (
+        "startup",
+        "discovery",
+        "sensor_read",
+        "control",
+        "actuator_write",
+        "report",
+    )
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        # monitors are created concurrently at startup
+        self.lock = threading.Lock()
+        self.profile = None
+        self.profile_deadline = None
+        self.reset()
+
+    def reset(self):
+        self.since = time.monotonic()
+        self.counts = dict.fromkeys(self.PHASES, 0)
+        self.totals = dict.fromkeys(self.PHASES, 0.0)
+        self.maxima = dict.fromkeys(self.PHASES, 0.0)
+        self.histograms = {
+            phase: [0] * (len(STATS_BUCKETS) + 1) for phase in self.PHASES
+        }
+
+    def clock(self):
+        return time.perf_counter() if self.enabled else 0.0
+
+    def lap(self, phase: str, start: float):
+        """Account the time elapsed since start to phase and return the clock,
+        to be used as the start of the next phase."""
+        if not self.enabled:
+            return 0.0
+        now = time.perf_counter()
+        elapsed = now - start
+        with self.lock:
+            self.counts[phase] += 1
+            self.totals[phase] += elapsed
+            if elapsed > self.maxima[phase]:
+                self.maxima[phase] = elapsed
+            self.histograms[phase][bisect.bisect_left(STATS_BUCKETS, elapsed)] += 1
+        return now
+
+    def summary(self):
+        """Return a human readable summary of the collected statistics."""
+        if not self.enabled:
+            return "stats: disabled"
+        lines = [f"stats: {time.monotonic() - self.since:.0f} seconds"]
+        bounds = [f"<{bound * 1000:g}ms" for bound in STATS_BUCKETS]
+        bounds.append(f">={STATS_BUCKETS[-1] * 1000:g}ms")
+        for phase in self.PHASES:
+            count = self.counts[phase]
+            if not count:
+                continue
+            histogram = " ".join(
+                f"{bound}:{n}"
+                for bound, n in zip(bounds, self.histograms[phase])
+                if n
+            )
+            lines.append(
+                f"stats: {phase}: count={count} "
+                f"mean={self.totals[phase] / count * 1000:.3f}ms "
+                f"max={self.maxima[phase] * 1000:.3f}ms || {histogram}"
+            )
+        return "\n".join(lines)
+
+    def start_profile(self, secs: float = PROFILE_SECS):
+        """Profile the process with cProfile for the next secs seconds."""
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.profile_deadline = time.monotonic() + secs
+
+    def poll_profile(self):
+        """Stop the cProfile window if it is over and print its results."""
+        if self.profile is None or time.monotonic() < self.profile_deadline:
+            return
+        self.profile.disable()
+        pstats.Stats(self.profile).sort_stats("cumulative").print_stats(
+            PROFILE_LINES
+        )
+        self.profile = None
+        self.profile_deadline = None
+
+
+STATS = Stats()
+
+# signals received but not yet handled by the control loop
+PENDING_SIGNALS = set()
+
+
+def install_signal_handlers():
+    """Defer handling of SIGHUP, SIGUSR1 and SIGUSR2 to handle_signals().
+
+    SIGHUP -- reload the fan curves from CONFIG_FILE
+    SIGUSR1 -- print the statistics (enabling them if they were disabled)
+    SIGUSR2 -- profile the process with cProfile for PROFILE_SECS seconds
+    """
+    for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, lambda signum, frame: PENDING_SIGNALS.add(signum))
+
+
+def handle_signals(monitors):
+    """Act upon the signals received since the last call."""
+    while PENDING_SIGNALS:
+        signum = PENDING_SIGNALS.pop()
+        if signum == signal.SIGHUP:
+            print(f"reloading {CONFIG_FILE}")
+            apply_config(monitors, CONFIG_FILE)
+        elif signum == signal.SIGUSR1:
+            if STATS.enabled:
+                print(STATS.summary())
+                for monitor in monitors:
+                    print(monitor.fan_writes_summary())
+            else:
+                STATS.enabled = True
+                STATS.reset()
+                print("stats: enabled")
+        elif signum == signal.SIGUSR2:
+            print(f"profiling for {PROFILE_SECS} seconds")
+            STATS.start_profile(PROFILE_SECS)
+    STATS.poll_profile()
+
+
+REPORT_LOCK = threading.Lock()
+
+
 class DeviceMonitor:
-    def __init__(self, device: str):
+    def __init__(self, device: str, state: dict = None):
         self.device = device
+        self.fan_curve = None
+        self.temp_filter = None
+        self.filter_band = FILTER_BAND
+        # filtered temperature when the last nonzero rate was passed on
+        self.filter_band_temp = None
+        self.rate_deadband = 0.0
+        self.saved_filter_state = None
+        self.fan_writes = 0
+        self.started = time.monotonic()
+        # a new monitor is updated right after its first sample is taken, too
+        # soon to compute a meaningful temperature rate from
+        self.rate_ready = bool(state)
+        if state:
+            self.restore(state)
+            return
         self.temp = get_temp(device)
         self.fan_speed = get_fan_speed(device)
         self.timestamp = datetime.now()
@@ -688,25 +1474,138 @@ class DeviceMonitor:
         self.last_report_timestamp = None
         self.report()
 
+    def get_state(self):
+        """Return the controller state as a JSON serializable dict."""
+        return {
+            "hwmon": HWMON_INDEX.get(self.device),
+            "temp": self.temp,
+            "fan_speed": self.fan_speed,
+            "timestamp": self.timestamp.timestamp(),
+            "last_report_temp": self.last_report_temp,
+            "last_report_timestamp": self.last_report_timestamp.timestamp(),
+            "filter": {
+                "name": self.temp_filter.NAME,
+                "params": self.temp_filter.params(),
+                "state": self.temp_filter.get_state(),
+                "band_temp": self.filter_band_temp,
+            }
+            if self.temp_filter
+            else None,
+        }
+
+    def restore(self, state: dict):
+        """Restore the controller state saved by get_state().
+
+        The next update() computes the temperature rate over the real gap
+        since the state was saved, so control resumes without a transient.
+        """
+        if state["hwmon"]:
+            HWMON_INDEX[self.device] = state["hwmon"]
+        self.temp = state["temp"]
+        self.fan_speed = state["fan_speed"]
+        self.timestamp = datetime.fromtimestamp(state["timestamp"])
+        self.last_report_temp = state["last_report_temp"]
+        self.last_report_timestamp = datetime.fromtimestamp(
+            state["last_report_timestamp"]
+        )
+        # the filter itself is only created by configure()
+        self.saved_filter_state = state.get("filter")
+
+    def configure(self, config: DeviceConfig):
+        """Apply the settings of a config file section.
+
+        The temperature filter is only replaced if its settings changed; a
+        new filter starts from the state saved before a restart, if any, or
+        else from the last temperature read.
+        """
+        self.fan_curve = config.fan_curve
+        self.filter_band = config.filter_band
+        self.rate_deadband = config.rate_deadband
+        if not config.matches_filter(self.temp_filter):
+            self.temp_filter = config.new_filter()
+            saved = self.saved_filter_state
+            if self.temp_filter is not None and not self.restore_filter(saved):
+                self.temp_filter.update(self.temp, self.timestamp.timestamp())
+                self.filter_band_temp = self.temp
+        self.saved_filter_state = None
+
+    def restore_filter(self, saved: dict):
+        """Restore the temperature filter state saved by get_state(), if it
+        was saved by a filter with the same settings, and return whether it
+        was restored."""
+        if (
+            not saved
+            or saved.get("name") != self.temp_filter.NAME
+            or saved.get("params") != self.temp_filter.params()
+        ):
+            return False
+        try:
+            self.temp_filter.set_state(saved["state"])
+            self.filter_band_temp = float(saved["band_temp"])
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning(
+                "GPU[%s]: Ignoring invalid saved filter state: %r",
+                parse_device_name(self.device),
+                e,
+            )
+            self.temp_filter = self.temp_filter.__class__(**self.temp_filter.params())
+            return False
+        return True
+
+    def filtered_temp_delta(self):
+        """Feed the last temperature to the filter and return the filtered rate,
+        or zero until the filtered temperature leaves the band of width
+        filter_band around the last temperature a rate was returned for."""
+        temp, rate = self.temp_filter.update(self.temp, self.timestamp.timestamp())
+        change = temp - self.filter_band_temp
+        if abs(change) < self.filter_band or change * rate <= 0.0:
+            return 0.0
+        self.filter_band_temp = temp
+        return rate
+
     def update(self):
+        start = STATS.clock()
         prev_timestamp, self.timestamp = self.timestamp, datetime.now()
         interval = (self.timestamp - prev_timestamp).total_seconds()
 
         prev_temp, self.temp = self.temp, get_temp(self.device)
-        temp_delta = (self.temp - prev_temp) / interval
-
         self.fan_speed = get_fan_speed(self.device)
-        fan_speed_delta = compute_fan_speed_delta(self.temp, temp_delta, self.fan_speed)
+        start = STATS.lap("sensor_read", start)
+
+        # the temperature filter only smooths the rate: HOT, COLD and fan
+        # curves are checked against the raw temperature so they act without lag
+        if self.fan_curve is not None:
+            # fan curves don't use the rate
+            temp_delta = 0.0
+        elif not self.rate_ready:
+            temp_delta = 0.0
+            self.rate_ready = True
+        elif self.temp_filter is None:
+            temp_delta = (self.temp - prev_temp) / interval
+        else:
+            temp_delta = self.filtered_temp_delta()
+        if abs(temp_delta) < self.rate_deadband:
+            temp_delta = 0.0
+        if self.fan_curve is None:
+            fan_speed_delta = compute_fan_speed_delta(
+                self.temp, temp_delta, self.fan_speed
+            )
+        else:
+            fan_speed_delta = self.fan_curve.fan_speed_delta(self.temp, self.fan_speed)
+        start = STATS.lap("control", start)
 
         logging.debug(
-            f"device={self.device}, "
-            f"temp={self.temp}, "
-            f"temp_delta={temp_delta}, "
-            f"fan_speed={self.fan_speed}%, "
-            f"delta={fan_speed_delta}"
+            "device=%s, temp=%s, temp_delta=%s, fan_speed=%s%%, delta=%s",
+            self.device,
+            self.temp,
+            temp_delta,
+            self.fan_speed,
+            fan_speed_delta,
         )
         if fan_speed_delta:
             set_fan_speed(self.device, self.fan_speed + fan_speed_delta)
+            self.fan_writes += 1
+            start = STATS.lap("actuator_write", start)
 
         temp_delta_since_last_report = self.temp - self.last_report_temp
         time_delta_since_last_report = self.timestamp - self.last_report_timestamp
@@ -715,23 +1614,141 @@ class DeviceMonitor:
             or time_delta_since_last_report.total_seconds() >= REPORT_DELTA_SECS
         ):
             self.report()
+        STATS.lap("report", start)
 
-    def report(self):
-        print(
-            f"device {self.device} || "
-            f"temperature: {self.temp}°C || "
-            f"fan speed: {self.fan_speed:.1f}%  "
+    def fan_writes_summary(self):
+        """Return how often the fan speed was set since the monitor started."""
+        hours = (time.monotonic() - self.started) / 3600
+        return (
+            f"stats: device {self.device}: "
+            f"fan writes: {self.fan_writes} ({self.fan_writes / hours:.1f}/hour)"
         )
+
+    def report(self):
+        # monitors are created concurrently, don't let their reports interleave
+        with REPORT_LOCK:
+            print(
+                f"device {self.device} || "
+                f"temperature: {self.temp}°C || "
+                f"fan speed: {self.fan_speed:.1f}%  "
+            )
         self.last_report_temp = self.temp
         self.last_report_timestamp = datetime.now()
 
 
+def save_state(monitors, path: str = STATE_FILE):
+    """Checkpoint the state of all device monitors to a file.
+
+    The file is replaced atomically so that a crash while writing never
+    leaves a truncated state behind.
+    """
+    state = {
+        "format": STATE_FORMAT,
+        "timestamp": time.time(),
+        "devices": {monitor.device: monitor.get_state() for monitor in monitors},
+    }
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning("Unable to save state to %s: %s", path, e)
+
+
+# types of the values saved by DeviceMonitor.get_state()
+DEVICE_STATE_TYPES = {
+    "hwmon": (str, type(None)),
+    "temp": (int, float),
+    "fan_speed": (int, float, type(None)),
+    "timestamp": (int, float),
+    "last_report_temp": (int, float),
+    "last_report_timestamp": (int, float),
+    "filter": (dict, type(None)),
+}
+
+
+def is_valid_device_state(state):
+    """Check whether a device state loaded from the state file can be passed
+    to DeviceMonitor.restore().
+
+    Parameters:
+    state -- a value of the "devices" dict saved by save_state()
+    """
+    return isinstance(state, dict) and all(
+        key in state and isinstance(state[key], types)
+        for key, types in DEVICE_STATE_TYPES.items()
+    )
+
+
+def load_state(path: str = STATE_FILE, max_age: float = STATE_MAX_AGE):
+    """Return the device states saved by save_state(), by device, or None if
+    there is no usable saved state.
+
+    Parameters:
+    path -- file written by save_state()
+    max_age -- saved state older than this many seconds is ignored
+    """
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning("Unable to load state from %s: %s", path, e)
+        return None
+    if not isinstance(state, dict) or state.get("format") != STATE_FORMAT:
+        logging.info("Ignoring saved state with unknown format in %s", path)
+        return None
+    devices = state.get("devices")
+    if not (
+        isinstance(state.get("timestamp"), (int, float))
+        and isinstance(devices, dict)
+        and all(
+            CARD_RE.match(device) and is_valid_device_state(device_state)
+            for device, device_state in devices.items()
+        )
+    ):
+        logging.warning("Ignoring invalid saved state in %s", path)
+        return None
+    age = time.time() - state["timestamp"]
+    if not 0 <= age <= max_age:
+        logging.info("Ignoring saved state from %.1f seconds ago", age)
+        return None
+    return devices or None
+
+
 def monitor_and_control():
-    monitors = [DeviceMonitor(device) for device in get_all_devices()]
+    started = time.monotonic()
+    install_signal_handlers()
+    start = STATS.clock()
+    saved_states = load_state(STATE_FILE, STATE_MAX_AGE) or {}
+    # cards may have been added, removed or renumbered since the state was
+    # saved, so only the HW Monitors of cards without saved state are resolved
+    devices = get_all_devices()
+    build_hwmon_index([device for device in devices if device not in saved_states])
+    resumed = [device for device in devices if device in saved_states]
+    if resumed:
+        logging.info("Resuming control of %d device(s)", len(resumed))
+    with ThreadPoolExecutor() as executor:
+        monitors = list(
+            executor.map(
+                lambda device: DeviceMonitor(device, saved_states.get(device)),
+                devices,
+            )
+        )
+    apply_config(monitors, CONFIG_FILE)
+    STATS.lap("startup", start)
+    print(f"startup took {time.monotonic() - started:.3f} seconds")
     while True:
-        time.sleep(UPDATE_INTERVAL)
         for monitor in monitors:
             monitor.update()
+        save_state(monitors, STATE_FILE)
+        if started is not None:
+            print(f"first control after {time.monotonic() - started:.3f} seconds")
+            started = None
+        handle_signals(monitors)
+        time.sleep(UPDATE_INTERVAL)
 
 
 if __name__ == "__main__":
@@ -746,4 +1763,5 @@ if __name__ == "__main__":
         if "-v" in sys.argv[1:]
         else logging.WARNING
     )
+    STATS.enabled = "--stats" in sys.argv[1:]
     monitor_and_control()